@@ -1,40 +1,224 @@
-import numpy as np 
-import pandas as pd 
-import urllib.request
-from urllib.request import urlopen
+import numpy as np
+import pandas as pd
+import http.client
+import json
+import os
+import re
+import shutil
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import HTTPError
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from zipfile import ZipFile
 from datetime import datetime
+from functools import cached_property
+from pathlib import Path
+
+try:
+    # pyarrow is optional, when installed every month is parsed into an arrow
+    # table on all cores and pandas only sees the joined result
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv, parquet as pq
+except ImportError:
+    pa = None
+
+__all__ = ['exness']
+
+HOST = 'ticks.ex2archive.com'
+BASE_PATH = '/ticks/'
+PAIRS_TTL = 24 * 60 * 60
+TIMEOUT = 30
+# one TLS context for every connection, so the CA bundle is loaded only once
+_SSL_CONTEXT = ssl.create_default_context()
+# transient failures are retried up to RETRIES times, backing off exponentially
+RETRIES = 3
+BACKOFF = 0.3
+RETRY_STATUS = frozenset([429, 502, 503, 504])
+RETRY_AFTER_MAX = 60
+# archives are buffered in memory up to SPOOL_SIZE bytes and spill to disk beyond
+SPOOL_SIZE = 8 << 20
+CHUNK_SIZE = 1 << 16
+
+# prices need no more than float32 precision, and a download holds a single symbol
+DTYPES = {'Bid': np.float32, 'Ask': np.float32, 'Symbol': 'category'}
+if pa is not None:
+    # tick timestamps are ISO 8601 in UTC, e.g. 2023-01-01 22:05:18.133Z
+    # every column is typed, so a month with only a header keeps the same schema
+    ARROW_TYPES = {
+        'Exness': pa.string(),
+        'Timestamp': pa.timestamp('ns', tz='UTC'),
+        'Bid': pa.float32(),
+        'Ask': pa.float32(),
+        'Symbol': pa.dictionary(pa.int32(), pa.string()),
+    }
+
+def _retry_after(response):
+    '''
+    seconds the server asked to wait before retrying, 0 when it gave none
+    only the delay-seconds form of Retry-After is honoured, capped at RETRY_AFTER_MAX
+    '''
+    try:
+        return min(max(int(response.headers.get('Retry-After', 0)), 0), RETRY_AFTER_MAX)
+    except ValueError:
+        return 0
+
+# entries of the archive's json directory listing: {"name":"EURUSD", ...}
+_PAIR_RE = re.compile(rb'"name"\s*:\s*"([^"]+)"')
+
+def _concat(months):
+    '''
+    concatenate the parsed months of a download into one DataFrame, emptying months
+    with pyarrow they are arrow tables, joined without copying and converted
+    to pandas once, column by column, so peak memory stays near the size of the result
+    '''
+    if pa is None:
+        # every month has the same columns, nothing to align or sort
+        data = pd.concat(months, axis=0, copy=False, sort=False)
+        months.clear()
+        return data
+    
+    table = pa.concat_tables(months)
+    months.clear()
+    
+    return table.to_pandas(self_destruct=True, split_blocks=True).set_index('Timestamp')
 
 class exness():
-    def __init__(self):
+    def __init__(self, max_workers=16, cache_dir=None):
+        '''
+        max_workers = number of months downloaded concurrently,
+        raise it for large historical backfills
+        cache_dir = where the pair list and downloaded archives are cached, defaults to ~/.cache/exfinance
+        '''
+        self.max_workers = max_workers
+        self.cache_dir = Path(cache_dir) if cache_dir else Path.home() / '.cache' / 'exfinance'
+        self._local = threading.local()
+        self._conns = set()
+        self._conns_lock = threading.Lock()
+        
+    def _connection(self):
+        '''
+        this thread's kept-alive HTTPS connection, opened on first use
+        every connection opened is recorded so _close_connections can close it
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or conn not in self._conns:
+            conn = self._local.conn = http.client.HTTPSConnection(HOST, timeout=TIMEOUT, context=_SSL_CONTEXT)
+            with self._conns_lock:
+                self._conns.add(conn)
+        
+        return conn
+        
+    def _drop_connection(self, conn):
+        '''
+        close a broken connection, this thread opens a new one on its next request
+        '''
+        conn.close()
+        with self._conns_lock:
+            self._conns.discard(conn)
+        self._local.conn = None
+        
+    def _close_connections(self):
+        '''
+        close every connection opened so far, including those of finished worker threads
+        '''
+        with self._conns_lock:
+            conns, self._conns = self._conns, set()
+        for conn in conns:
+            conn.close()
+        
+    def _get(self, path, file):
+        '''
+        stream the body at path on ex2archive into the binary file
+        each thread keeps its own HTTPS connection alive and reuses it between
+        requests, so only its first one pays for the TCP + TLS handshake
+        transient failures, including ones partway through the body, are
+        retried after truncating file
+        '''
+        for attempt in range(RETRIES + 1):
+            file.seek(0)
+            file.truncate()
+            conn = self._connection()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                if response.status == 200:
+                    shutil.copyfileobj(response, file, CHUNK_SIZE)
+                    return
+                response.read()
+            except (http.client.HTTPException, OSError):
+                # dropped, reset or timed out connection, reconnect and try again
+                self._drop_connection(conn)
+                if attempt == RETRIES:
+                    raise
+                # the first retry is immediate, it usually only replaces a stale connection
+                if attempt:
+                    time.sleep(BACKOFF * 2 ** attempt)
+                continue
+            if response.status not in RETRY_STATUS or attempt == RETRIES:
+                raise HTTPError(f'https://{HOST}{path}', response.status, response.reason, response.headers, None)
+            time.sleep(max(BACKOFF * 2 ** attempt, _retry_after(response)))
+        
+    @cached_property
+    def available_pairs(self):
+        '''
+        set of all available pairs and assets on ex2archive
+        fetched on first use only and cached on disk for PAIRS_TTL seconds,
+        an expired cache is still used when the listing can't be fetched
+        '''
+        cache_file = self.cache_dir / 'pairs.json'
+        try:
+            age = time.time() - cache_file.stat().st_mtime
+            cached = frozenset(json.loads(cache_file.read_text()))
+            if age < PAIRS_TTL:
+                return cached
+        except (OSError, ValueError):
+            cached = None
         
-        self.get_data()
+        try:
+            pairs = self._fetch_pairs()
+        except (OSError, http.client.HTTPException, ValueError):
+            # offline or the listing changed format, a stale list beats none
+            if cached is None:
+                raise
+            return cached
         
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+            tmp_file.write_text(json.dumps(sorted(pairs)))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+        
+        return pairs
         
     def get_data(self):
         '''
         get data from ex2archive
         get_data will return a list of all available pairs and assets on ex2archive
         '''
-
-        url = 'https://ticks.ex2archive.com/ticks/'
-        uf = urllib.request.urlopen(url)
-        html = uf.read()
-        html = html.decode("utf-8")
-        html = html.split('\r\n')
-        html[2].split()[1].split(':')[1].split(',')[0].split('"')
-
-        cols = []
-
-        for i in range(1, len(html)-1):
-            raw = html[i].split()[1].split(':')[1].split(',')[0].split('"')[1]
-            cols.append(raw)
-
-        self.cols = cols
+        self.cols = sorted(self.available_pairs)
         
         return self.cols
 
+    def _fetch_pairs(self):
+        '''
+        fetch and parse the list of pairs from the ex2archive index page
+        '''
+        html = BytesIO()
+        try:
+            self._get(BASE_PATH, html)
+        finally:
+            self._close_connections()
+        pairs = frozenset(name.decode() for name in _PAIR_RE.findall(html.getvalue()))
+        if not pairs:
+            raise ValueError('no pairs found in the ex2archive listing')
+        
+        return pairs
+
     def parse_dates(self, start=None, end=None):
 
         '''
@@ -49,39 +233,124 @@ class exness():
         if self.end is None:
             self.end = datetime.today()
 
-        #self.start = datetime.strptime(self.start, '%Y-%m-%d')
-        #self.end = datetime.strptime(self.end, '%Y-%m-%d')
-        
-        self.dates = pd.date_range(self.start, self.end, freq='m')
+        # one month-start timestamp per month, from the month of start up to the
+        # last month that has ended by end, as only finished months are archived
+        first = pd.Timestamp(self.start).to_period('M').to_timestamp()
+        stop = (pd.Timestamp(self.end).normalize() + pd.Timedelta(days=1)).to_period('M').to_timestamp()
+        # on the last day of a month that month has not been published yet either
+        stop = min(stop, pd.Timestamp.today().to_period('M').to_timestamp())
+        self.dates = pd.date_range(first, stop - pd.offsets.MonthBegin(), freq='MS')
         
         return self.dates
         
-    def download(self, pair, start, end):
+    def _save(self, path, file):
+        '''
+        stream the archive at path into file
+        the file is written under a temporary name and then renamed,
+        so an interrupted download never leaves a truncated zip behind
+        '''
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = file.with_name(f'{file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp_file, 'wb') as f:
+                self._get(path, f)
+            os.replace(tmp_file, file)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+        
+    def _fetch_month(self, date):
+        '''
+        fetch the archive of self.pair for the month of date
+        returns the archive as an open binary file and the stem of its name
+        '''
+        yyyy, mm = date.year, f'{date.month:02d}'
+        stem = f'Exness_{self.pair}_{yyyy}_{mm}'
+        path = f'{BASE_PATH}{self.pair}/{yyyy}/{mm}/{stem}.zip'
+        # archives of finished months never change, so they are kept on disk
+        # and downloading the same month again skips the network entirely
+        cache_file = self.cache_dir / self.pair / str(yyyy) / f'{mm}.zip'
+        if date.to_period('M') < pd.Timestamp.today().to_period('M'):
+            if not (cache_file.is_file() and cache_file.stat().st_size):
+                print(f'downloading: {self.pair} | {mm}')
+                self._save(path, cache_file)
+            return open(cache_file, 'rb'), stem
+        
+        print(f'downloading: {self.pair} | {mm}')
+        spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            self._get(path, spool)
+        except BaseException:
+            spool.close()
+            raise
+        
+        return spool, stem
+        
+    def _read_month(self, archive, stem, save_path=None):
+        '''
+        parse the csv of one month straight out of its archive, without extracting it
+        the archive is closed afterwards
+        returns an arrow table when pyarrow is installed, a DataFrame otherwise
+        '''
+        with archive, ZipFile(archive) as zipfile, zipfile.open(f'{stem}.csv') as csvfile:
+            if pa is None:
+                month = pd.read_csv(csvfile, dtype=DTYPES, parse_dates=['Timestamp'], index_col=['Timestamp'])
+            else:
+                month = pa_csv.read_csv(csvfile, convert_options=pa_csv.ConvertOptions(column_types=ARROW_TYPES))
+        if save_path is not None:
+            pq.write_table(month, save_path / f'{stem}.parquet', compression='zstd')
+        
+        return month
+        
+    def download(self, pair, start, end, save_path=None):
         '''
         returns a DataFrame Object for the selected pair 
         start = start date  
         end = end date
         dates should be either a year or in the format of 'year-month-day' --> '2022-10-23'
+        save_path = optional directory to also save every month to as parquet (needs pyarrow)
         '''
         self.pair = pair.upper()
+        if self.pair not in self.available_pairs:
+            raise ValueError(f'{self.pair} is not available on ex2archive')
 
-        self.parse_dates()
-        
-        files = []
-        for i in range(len(self.dates)):
-            url = f'https://ticks.ex2archive.com/ticks/{self.pair}/{self.dates[i].year}/{datetime.strftime(self.dates[i], "%m")}/Exness_{self.pair}_{self.dates[i].year}_{datetime.strftime(self.dates[i], "%m")}.zip'
-            print(f'downloading: {self.pair} | {datetime.strftime(self.dates[i], "%m")}')
-            http_response = urlopen(url)
-            zipfile = ZipFile(BytesIO(http_response.read()))
-            zipfile.extractall(path='')
-            file = f'Exness_{self.pair}_{self.dates[i].year}_{datetime.strftime(self.dates[i], "%m")}.csv'
-            files.append(file)
-        
-        data = pd.DataFrame()
-        
-        for file in files:
-            f = pd.read_csv(file, parse_dates=True, index_col=['Timestamp'])
-            data = data.append(f)
-        self.data = data
+        self.parse_dates(start, end)
+        if not len(self.dates):
+            raise ValueError(f'no finished months between {start} and {self.end}')
+        if save_path is not None:
+            if pa is None:
+                raise ImportError('save_path needs pyarrow to write parquet, install it with pip install pyarrow')
+            save_path = Path(save_path)
+            save_path.mkdir(parents=True, exist_ok=True)
+        
+        # downloads are network bound, so size the pool by in-flight requests
+        # rather than cores and don't spawn idle threads for short ranges
+        workers = max(1, min(len(self.dates), self.max_workers))
+        # one slot per month, filled in whatever order downloads finish,
+        # so the result stays chronological without sorting
+        months = [None] * len(self.dates)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._fetch_month, date): i for i, date in enumerate(self.dates)}
+                unread = set(futures)
+                try:
+                    # parse each month here as soon as its download completes while the
+                    # workers keep fetching the rest, so parsing overlaps the network
+                    for future in as_completed(futures):
+                        unread.discard(future)
+                        months[futures[future]] = self._read_month(*future.result(), save_path)
+                except BaseException:
+                    # don't download the remaining months just to report the failure,
+                    # and close the archives that were fetched but never read
+                    executor.shutdown(cancel_futures=True)
+                    for future in unread:
+                        if not future.cancelled() and future.exception() is None:
+                            future.result()[0].close()
+                    raise
+        finally:
+            # the pool has drained, none of its connections will be used again
+            self._close_connections()
+        
+        self.data = _concat(months)
         
         return self.data
\ No newline at end of file
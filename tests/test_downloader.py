@@ -0,0 +1,292 @@
+import io
+import threading
+import zipfile
+
+import pandas as pd
+import pytest
+
+from exfinance import downloader
+from exfinance.downloader import exness
+
+LISTING = b'[\r\n{ "name":"EURUSD", "type":"directory" },\r\n{ "name":"XAUUSD", "type":"directory" }\r\n]'
+HEADER = b'"Exness","Symbol","Timestamp","Bid","Ask"\n'
+
+
+def month_zip(yyyy, mm, rows=True):
+    body = HEADER
+    if rows:
+        body += f'"exness","EURUSD","{yyyy}-{mm}-02 00:00:01.123Z",1.0701,1.0703\n'.encode()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr(f'Exness_EURUSD_{yyyy}_{mm}.csv', body)
+    return buffer.getvalue()
+
+
+class FakeResponse(io.BytesIO):
+    '''
+    response whose body read raises ConnectionResetError after reset_after bytes
+    '''
+    def __init__(self, status=200, body=b'', headers=None, reset_after=None):
+        super().__init__(body)
+        self.status = status
+        self.reason = 'fake'
+        self.headers = headers or {}
+        self.reset_after = reset_after
+
+    def read(self, size=-1):
+        if self.reset_after is not None and self.tell() >= self.reset_after:
+            raise ConnectionResetError
+        if self.reset_after is not None:
+            size = self.reset_after - self.tell()
+        return super().read(size)
+
+
+class FakeConnection:
+    '''
+    stands in for http.client.HTTPSConnection, serving FakeConnection.routes
+    routes map a path to a list of responses, or exceptions to raise, used in turn
+    '''
+    routes = {}
+    opened = []
+    requests = []
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        self.closed = False
+        with self.lock:
+            self.opened.append(self)
+
+    def request(self, method, path):
+        self.path = path
+        with self.lock:
+            self.requests.append(path)
+
+    def getresponse(self):
+        with self.lock:
+            responses = self.routes[self.path]
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+        if isinstance(response, BaseException):
+            raise response
+        return FakeResponse(*response)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_http(monkeypatch):
+    monkeypatch.setattr(downloader.http.client, 'HTTPSConnection', FakeConnection)
+    monkeypatch.setattr(downloader.time, 'sleep', lambda seconds: None)
+    FakeConnection.routes = {downloader.BASE_PATH: [(200, LISTING)]}
+    FakeConnection.opened = []
+    FakeConnection.requests = []
+    return FakeConnection
+
+
+def serve_months(fake_http, *months, rows=True):
+    for yyyy, mm in months:
+        path = f'{downloader.BASE_PATH}EURUSD/{yyyy}/{mm}/Exness_EURUSD_{yyyy}_{mm}.zip'
+        fake_http.routes[path] = [(200, month_zip(yyyy, mm, rows))]
+
+
+def test_parse_dates_leaves_out_unfinished_month(tmp_path):
+    ex = exness(cache_dir=tmp_path)
+
+    assert len(ex.parse_dates('2023-05-20', '2023-05-25')) == 0
+    assert [d.strftime('%Y-%m') for d in ex.parse_dates('2023-04-20', '2023-05-15')] == ['2023-04']
+    assert [d.strftime('%Y-%m') for d in ex.parse_dates('2023-04-20', '2023-05-31')] == ['2023-04', '2023-05']
+
+
+def test_parse_dates_leaves_out_current_month_on_its_last_day(tmp_path):
+    ex = exness(cache_dir=tmp_path)
+    this_month = pd.Timestamp.today().to_period('M')
+    last_day = this_month.to_timestamp(how='end').replace(hour=9)
+
+    dates = ex.parse_dates((this_month - 1).to_timestamp(), last_day)
+
+    assert [d.to_period('M') for d in dates] == [this_month - 1]
+
+
+def test_download_closes_every_connection(tmp_path, fake_http):
+    serve_months(fake_http, ('2023', '01'), ('2023', '02'), ('2023', '03'))
+    ex = exness(max_workers=3, cache_dir=tmp_path)
+
+    data = ex.download('eurusd', '2023-01-01', '2023-03-31')
+
+    assert len(data) == 3
+    assert data.index.is_monotonic_increasing
+    assert fake_http.opened
+    assert all(conn.closed for conn in fake_http.opened)
+
+
+@pytest.mark.parametrize('arrow', [True, False])
+def test_download_with_a_header_only_month(tmp_path, fake_http, monkeypatch, arrow):
+    if arrow:
+        pytest.importorskip('pyarrow')
+    else:
+        monkeypatch.setattr(downloader, 'pa', None)
+    serve_months(fake_http, ('2023', '01'))
+    serve_months(fake_http, ('2023', '02'), rows=False)
+    ex = exness(cache_dir=tmp_path)
+
+    data = ex.download('EURUSD', '2023-01-01', '2023-02-28')
+
+    assert len(data) == 1
+    assert list(data.columns) == ['Exness', 'Symbol', 'Bid', 'Ask']
+    assert data['Bid'].dtype == 'float32'
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(downloader.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_get_retries_a_reset_partway_through_the_body(tmp_path, fake_http, sleeps):
+    body = b'x' * 1000
+    fake_http.routes['/a'] = [(200, body, {}, 300), (200, body)]
+    ex = exness(cache_dir=tmp_path)
+    file = io.BytesIO()
+
+    ex._get('/a', file)
+
+    assert file.getvalue() == body
+    assert len(fake_http.opened) == 2 and fake_http.opened[0].closed
+    # the first retry after a connection error is immediate
+    assert sleeps == []
+
+
+def test_get_backs_off_on_retryable_status(tmp_path, fake_http, sleeps):
+    fake_http.routes['/a'] = [(503,), (429, b'', {'Retry-After': '5'}), (200, b'ok')]
+    ex = exness(cache_dir=tmp_path)
+    file = io.BytesIO()
+
+    ex._get('/a', file)
+
+    assert file.getvalue() == b'ok'
+    assert sleeps == [downloader.BACKOFF, 5]
+
+
+def test_get_gives_up_after_retries(tmp_path, fake_http, sleeps):
+    fake_http.routes['/a'] = [(503,)]
+    ex = exness(cache_dir=tmp_path)
+
+    with pytest.raises(downloader.HTTPError) as error:
+        ex._get('/a', io.BytesIO())
+
+    assert error.value.code == 503
+    assert len(fake_http.requests) == downloader.RETRIES + 1
+    assert sleeps == [downloader.BACKOFF * 2 ** attempt for attempt in range(downloader.RETRIES)]
+
+
+def test_get_does_not_retry_a_missing_archive(tmp_path, fake_http, sleeps):
+    fake_http.routes['/a'] = [(404,)]
+    ex = exness(cache_dir=tmp_path)
+
+    with pytest.raises(downloader.HTTPError) as error:
+        ex._get('/a', io.BytesIO())
+
+    assert error.value.code == 404
+    assert len(fake_http.requests) == 1
+
+
+def stub_get(monkeypatch, ex, *bodies):
+    '''
+    replace ex._get with one writing bodies in turn, exceptions are raised instead
+    returns the list of requested paths
+    '''
+    paths = []
+    bodies = list(bodies)
+
+    def _get(path, file):
+        paths.append(path)
+        body = bodies.pop(0) if len(bodies) > 1 else bodies[0]
+        if isinstance(body, BaseException):
+            file.write(b'partial')
+            raise body
+        file.write(body)
+
+    monkeypatch.setattr(ex, '_get', _get)
+    return paths
+
+
+def test_finished_month_is_downloaded_once_then_read_from_cache(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    ex.pair = 'EURUSD'
+    paths = stub_get(monkeypatch, ex, month_zip('2023', '01'))
+
+    for _ in range(2):
+        archive, stem = ex._fetch_month(pd.Timestamp('2023-01-01'))
+        with archive, zipfile.ZipFile(archive) as zf:
+            assert zf.namelist() == [f'{stem}.csv']
+
+    assert len(paths) == 1
+    assert (tmp_path / 'EURUSD' / '2023' / '01.zip').is_file()
+
+
+def test_current_month_is_never_cached(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    ex.pair = 'EURUSD'
+    today = pd.Timestamp.today()
+    paths = stub_get(monkeypatch, ex, month_zip(today.year, f'{today.month:02d}'))
+
+    for _ in range(2):
+        archive, _ = ex._fetch_month(today.to_period('M').to_timestamp())
+        archive.close()
+
+    assert len(paths) == 2
+    assert not (tmp_path / 'EURUSD').exists()
+
+
+def test_failed_download_leaves_nothing_in_the_cache(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    ex.pair = 'EURUSD'
+    paths = stub_get(monkeypatch, ex, ConnectionResetError(), month_zip('2023', '01'))
+
+    with pytest.raises(ConnectionResetError):
+        ex._fetch_month(pd.Timestamp('2023-01-01'))
+    assert list((tmp_path / 'EURUSD' / '2023').iterdir()) == []
+
+    archive, _ = ex._fetch_month(pd.Timestamp('2023-01-01'))
+    archive.close()
+    assert len(paths) == 2
+
+
+def test_pair_listing_is_parsed_and_cached(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    stub_get(monkeypatch, ex, LISTING)
+
+    assert ex.get_data() == ['EURUSD', 'XAUUSD']
+    assert exness(cache_dir=tmp_path).available_pairs == frozenset(['EURUSD', 'XAUUSD'])
+
+
+def test_empty_pair_listing_raises(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    stub_get(monkeypatch, ex, b'<html>maintenance</html>')
+
+    with pytest.raises(ValueError):
+        ex.available_pairs
+    assert not (tmp_path / 'pairs.json').exists()
+
+
+def test_stale_pair_listing_is_used_when_offline(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    stub_get(monkeypatch, ex, LISTING)
+    ex.available_pairs
+    expired = (tmp_path / 'pairs.json').stat().st_mtime - downloader.PAIRS_TTL - 1
+    downloader.os.utime(tmp_path / 'pairs.json', (expired, expired))
+
+    ex = exness(cache_dir=tmp_path)
+    paths = stub_get(monkeypatch, ex, OSError('offline'))
+
+    assert ex.available_pairs == frozenset(['EURUSD', 'XAUUSD'])
+    assert paths == [downloader.BASE_PATH]
+
+
+def test_download_rejects_unknown_pair(tmp_path, monkeypatch):
+    ex = exness(cache_dir=tmp_path)
+    stub_get(monkeypatch, ex, LISTING)
+
+    with pytest.raises(ValueError):
+        ex.download('GBPJPY', '2023-01-01', '2023-01-31')